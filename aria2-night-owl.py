@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import sys
+import glob
+import json
 import time
+import heapq
+import pickle
+import random
+import socket
+import hashlib
 import logging
 import argparse
+import itertools
+import threading
 import subprocess
+import collections
+import urllib.error
+import urllib.request
 
-from datetime import datetime
+from typing import NamedTuple, Optional
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import yaml
 
@@ -54,12 +71,222 @@ def parse_args():
 	parser.add_argument(
 		"yaml_path", type=str, help="Path to the YAML configuration file."
 	)
+	parser.add_argument(
+		"-j",
+		"--max-concurrent",
+		type=int,
+		help="Number of simultaneous downloads (overrides defaults.max-concurrent).",
+	)
+	parser.add_argument(
+		"--engine",
+		choices=["process", "rpc"],
+		help="Run one aria2c per URL (process) or drive one over JSON-RPC (rpc).",
+	)
+	parser.add_argument(
+		"--rpc-url",
+		type=str,
+		help="Attach to a running aria2c RPC endpoint instead of starting one.",
+	)
+	parser.add_argument(
+		"--rpc-secret", type=str, help="Secret token of the RPC endpoint."
+	)
+	parser.add_argument(
+		"--check",
+		action="store_true",
+		help="Validate the configuration (and its includes) and exit.",
+	)
+	parser.add_argument(
+		"--no-cache",
+		action="store_true",
+		help="Ignore and do not write the compiled configuration cache.",
+	)
+	parser.add_argument(
+		"--probe",
+		action="store_true",
+		help="Probe sizes with HEAD requests and order the queue to beat end-time.",
+	)
+	parser.add_argument(
+		"--raw-output",
+		action="store_true",
+		help="Echo aria2c output instead of only collecting progress metrics.",
+	)
+	parser.add_argument(
+		"--journal",
+		type=str,
+		help="State journal path (overrides defaults.journal; empty disables it).",
+	)
 	return parser.parse_args()
 
 
+SUMMARY_INTERVAL = 15
+RPC_STATUS_KEYS = [
+	"status",
+	"totalLength",
+	"completedLength",
+	"downloadSpeed",
+	"connections",
+	"errorCode",
+	"errorMessage",
+]
+
+
+CONFIG_CACHE_VERSION = 2
+CONFIG_CACHE_DIR = os.path.join(
+	os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "aria2-night-owl"
+)
+URL_SCHEMES = ("http", "https", "ftp", "sftp", "magnet")
+URL_OPTIONS = {
+	"dir": str,
+	"out": str,
+	"conf": str,
+	"retry-file": int,
+	"proxify": bool,
+	"max-connections": int,
+	"max-speed": (int, str),
+}
+
+
+class UrlSpec(NamedTuple):
+	url: str
+	dir: str = ""
+	out: str = ""
+	conf: str = ""
+	retry_file: int = 0
+	proxify: Optional[bool] = None
+	max_connections: int = 0
+	max_speed: int = 0
+
+
 def load_yaml(filepath):
+	# The libyaml backed loader is several times faster on large files.
+	loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 	with open(filepath, "r") as file:
-		return yaml.safe_load(file)
+		return yaml.load(file, Loader=loader)
+
+
+def compile_entry(url, value) -> UrlSpec:
+	"""Validates one URL entry; raises ValueError describing what is wrong."""
+
+	if not isinstance(url, str) or urlparse(url).scheme not in URL_SCHEMES:
+		raise ValueError("not a supported URL")
+	if value is None:
+		return UrlSpec(url)
+	if isinstance(value, str):
+		return UrlSpec(url, dir=value)
+	if not isinstance(value, dict):
+		raise ValueError(f"expected a directory or a mapping, got {value!r}")
+
+	unknown = set(value) - set(URL_OPTIONS)
+	if unknown:
+		raise ValueError(f"unknown options {', '.join(sorted(map(str, unknown)))}")
+	for key, value_type in URL_OPTIONS.items():
+		if value.get(key) is not None and not isinstance(value[key], value_type):
+			raise ValueError(f"{key} has the wrong type: {value[key]!r}")
+
+	return UrlSpec(
+		url,
+		dir=value.get("dir") or "",
+		out=value.get("out") or "",
+		conf=value.get("conf") or "",
+		retry_file=value.get("retry-file") or 0,
+		proxify=value.get("proxify"),
+		max_connections=value.get("max-connections") or 0,
+		max_speed=parse_speed(value.get("max-speed")),
+	)
+
+
+def read_config(filepath, specs, errors, files, globs):
+	"""Compiles the URLs of one YAML file and its includes into `specs`.
+
+	Includes are listed under `defaults.include`, relative to the including file
+	and may be globs. Only the defaults of the top-level file are used. The files
+	read go to `files` and every include pattern with its matches to `globs`.
+	"""
+
+	files.append(os.path.abspath(filepath))
+	data = load_yaml(filepath) or dict()
+	if not isinstance(data, dict):
+		errors.append(f"{filepath}: expected a mapping of URLs")
+		return dict()
+
+	defaults = data.pop("defaults", None) or dict()
+	for url, value in data.items():
+		try:
+			specs[url] = compile_entry(url, value)
+		except ValueError as e:
+			errors.append(f"{filepath}: {url}: {e}")
+
+	includes = defaults.pop("include", None) or list()
+	if isinstance(includes, str):
+		includes = [includes]
+	for pattern in includes:
+		pattern = os.path.join(os.path.dirname(filepath), os.path.expanduser(pattern))
+		matches = sorted(glob.glob(pattern))
+		globs.append((pattern, matches))
+		if not matches:
+			errors.append(f"{filepath}: include {pattern} matched no files")
+		for include in matches:
+			if os.path.abspath(include) not in files:
+				read_config(include, specs, errors, files, globs)
+
+	return defaults
+
+
+def fingerprint(files):
+	return [(path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in files]
+
+
+def compile_config(filepath, use_cache=True):
+	"""Returns the raw defaults, the validated UrlSpecs and the validation errors.
+
+	The result is cached per configuration file and reused for as long as the
+	mtime and size of the file and all of its includes are unchanged and every
+	include pattern still matches the same files. Defaults
+	are cached raw, since some of them are resolved against the current time.
+	"""
+
+	digest = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()
+	cache_path = os.path.join(CONFIG_CACHE_DIR, f"{digest}.pickle")
+
+	if use_cache:
+		try:
+			with open(cache_path, "rb") as file:
+				cache = pickle.load(file)
+			if (
+				cache["version"] == CONFIG_CACHE_VERSION
+				and fingerprint(f for f, _, _ in cache["files"]) == cache["files"]
+				and all(sorted(glob.glob(p)) == m for p, m in cache["globs"])
+			):
+				return cache["defaults"], cache["specs"], cache["errors"]
+		except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+			pass
+
+	specs, errors, files, globs = dict(), list(), list(), list()
+	defaults = read_config(filepath, specs, errors, files, globs)
+	specs = list(specs.values())
+
+	if use_cache:
+		try:
+			os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+			tmp_path = f"{cache_path}.tmp"
+			with open(tmp_path, "wb") as file:
+				pickle.dump(
+					{
+						"version": CONFIG_CACHE_VERSION,
+						"files": fingerprint(files),
+						"globs": globs,
+						"defaults": defaults,
+						"specs": specs,
+						"errors": errors,
+					},
+					file,
+					protocol=pickle.HIGHEST_PROTOCOL,
+				)
+			os.replace(tmp_path, cache_path)
+		except OSError:
+			pass
+
+	return defaults, specs, errors
 
 
 def build_aria2c_command(url, opts):
@@ -74,35 +301,454 @@ def build_aria2c_command(url, opts):
 	if opts["retry-file"]:
 		cmd.append(f"--max-tries={opts['retry-file']}")
 
-	cmd.extend(["--console-log-level=notice", "--summary-interval=15"])
+	if opts.get("continue"):
+		cmd.append("--continue=true")
+
+	if opts.get("max-connections"):
+		cmd.append(f"--max-connection-per-server={opts['max-connections']}")
+		cmd.append(f"--split={opts['max-connections']}")
+
+	if opts.get("max-speed"):
+		cmd.append(f"--max-download-limit={opts['max-speed']}")
+
+	cmd.extend(["--console-log-level=notice", f"--summary-interval={SUMMARY_INTERVAL}"])
 
 	cmd.append(url)
 	return cmd
 
 
-def run_download(url, opts):
+def build_env(opts, proxy_vars):
+	# Each worker gets its own environment so that concurrent downloads
+	# with different `proxify` settings do not race on os.environ.
+	env = os.environ.copy()
+	for var in proxy_vars:
+		if opts["proxify"]:
+			env[var] = proxy_vars[var]
+		elif var in env:
+			del env[var]
+	return env
+
+
+PROGRESS_RE = re.compile(
+	r"\[#(?P<gid>\w+) (?P<done>[\d.]+\w*)/(?P<total>[\d.]+\w*)(?:\(\d+%\))?"
+	r" CN:(?P<connections>\d+)(?:.*? DL:(?P<speed>[\d.]+\w*))?"
+	r"(?:.*? ETA:(?P<eta>\w+))?\]"
+)
+SIZE_UNITS = {"B": 1, "KIB": 1024, "MIB": 1024**2, "GIB": 1024**3, "TIB": 1024**4}
+
+
+def parse_size(value) -> int:
+	match = re.fullmatch(r"([\d.]+)(\w*)", value)
+	if not match:
+		return 0
+	return int(float(match[1]) * SIZE_UNITS.get(match[2].upper() or "B", 1))
+
+
+def parse_eta(value) -> int:
+	units = {"h": 3600, "m": 60, "s": 1}
+	return sum(int(n) * units[u] for n, u in re.findall(r"(\d+)([hms])", value or ""))
+
+
+class Metrics:
+	"""Thread-safe per-download progress, periodically written as a snapshot.
+
+	The snapshot is JSON, or a Prometheus textfile when the path ends in `.prom`.
+	"""
+
+	GAUGES = {
+		"bytes-done": "Bytes downloaded so far.",
+		"bytes-total": "Size of the download in bytes.",
+		"speed": "Current download speed in bytes per second.",
+		"eta": "Estimated seconds until the download completes.",
+		"connections": "Open connections of the download.",
+	}
+
+	def __init__(self, path="", interval=SUMMARY_INTERVAL):
+		self.path = path
+		self.interval = interval
+		self.downloads = dict()
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = None
+
+	def update(self, url, **values):
+		with self._lock:
+			self.downloads.setdefault(url, dict.fromkeys(self.GAUGES, 0)).update(values)
+
+	def finish(self, url, success):
+		with self._lock:
+			values = self.downloads.setdefault(url, dict.fromkeys(self.GAUGES, 0))
+			values.update(status="success" if success else "failed")
+			values.update(speed=0, eta=0, connections=0)
+			if success and values["bytes-total"]:
+				values["bytes-done"] = values["bytes-total"]
+
+	def speed(self) -> int:
+		with self._lock:
+			return sum(
+				v["speed"]
+				for v in self.downloads.values()
+				if v.get("status") == "active"
+			)
+
+	def snapshot(self):
+		with self._lock:
+			downloads = {url: dict(values) for url, values in self.downloads.items()}
+		active = [v for v in downloads.values() if v.get("status") == "active"]
+		return {
+			"time": datetime.now().isoformat(),
+			"speed": sum(v["speed"] for v in active),
+			"active": len(active),
+			"downloads": downloads,
+		}
+
+	def _render_prometheus(self, snapshot):
+		def label(url):
+			return url.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+		lines = [
+			"# HELP night_owl_speed_bytes Total download speed in bytes per second.",
+			"# TYPE night_owl_speed_bytes gauge",
+			f"night_owl_speed_bytes {snapshot['speed']}",
+			"# HELP night_owl_active_downloads Downloads currently in progress.",
+			"# TYPE night_owl_active_downloads gauge",
+			f"night_owl_active_downloads {snapshot['active']}",
+		]
+		for key, help_text in self.GAUGES.items():
+			name = f"night_owl_download_{key.replace('-', '_')}"
+			lines.append(f"# HELP {name} {help_text}")
+			lines.append(f"# TYPE {name} gauge")
+			for url, values in snapshot["downloads"].items():
+				status = values.get("status", "")
+				lines.append(
+					f'{name}{{url="{label(url)}",status="{status}"}} {values[key]}'
+				)
+		return "\n".join(lines) + "\n"
+
+	def write(self):
+		if not self.path:
+			return
+		snapshot = self.snapshot()
+		if self.path.endswith(".prom"):
+			content = self._render_prometheus(snapshot)
+		else:
+			content = json.dumps(snapshot, indent=2)
+
+		# Write atomically so collectors never read a half-written file.
+		tmp_path = f"{self.path}.tmp"
+		with open(tmp_path, "w") as file:
+			file.write(content)
+		os.replace(tmp_path, self.path)
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			try:
+				self.write()
+			except OSError as e:
+				logging.warning(f"Could not write metrics to {self.path}: {e}")
+
+	def start(self):
+		if self.path:
+			os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+			self._thread = threading.Thread(target=self._run, daemon=True)
+			self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+		self.write()
+
+
+def run_download(url, opts, metrics, env=None, raw_output=False):
 	cmd = build_aria2c_command(url, opts)
 	os.makedirs(opts["dir"], exist_ok=True)
 	logging.debug(f"Starting download for :: {' '.join(cmd)}")
 
 	process = subprocess.Popen(
-		cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+		cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env
 	)
 
-	while True:
-		output = process.stdout.readline()
-		if output == "" and process.poll() is not None:
-			break
-		if output:
-			print(output.strip())  # Directly output to Python's stdout
+	metrics.update(url, status="active")
+	# Without raw output only the tail is kept, to explain a failure.
+	tail = collections.deque(maxlen=5)
+	for line in process.stdout:
+		if raw_output:
+			print(line.strip())  # Directly output to Python's stdout
+
+		match = PROGRESS_RE.search(line) if line.startswith("[#") else None
+		if match:
+			metrics.update(
+				url,
+				**{
+					"bytes-done": parse_size(match["done"]),
+					"bytes-total": parse_size(match["total"]),
+					"speed": parse_size(match["speed"] or "0"),
+					"eta": parse_eta(match["eta"]),
+					"connections": int(match["connections"]),
+				},
+			)
+		elif line.strip():
+			tail.append(line.strip())
 
 	process.stdout.close()
+	process.wait()
 
 	if process.returncode == 0:
+		metrics.finish(url, True)
 		logging.debug(f"Download successful for {url}")
 		return True
 	else:
+		metrics.finish(url, False)
 		logging.error(f"Download failed for {url} with error: {process.returncode}")
+		if not raw_output:
+			for line in tail:
+				logging.error(f"    {line}")
+		return False
+
+
+class Aria2RPCError(Exception):
+	pass
+
+
+class Aria2RPC:
+	"""Minimal JSON-RPC client for aria2c, safe to share between worker threads."""
+
+	def __init__(self, url, secret=""):
+		self.url = url
+		self.secret = secret
+		self._ids = itertools.count()
+		# Never send RPC traffic for a local daemon through the download proxy.
+		self._opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+	def call(self, method, *params):
+		params = list(params)
+		if self.secret:
+			params.insert(0, f"token:{self.secret}")
+		payload = json.dumps(
+			{
+				"jsonrpc": "2.0",
+				"id": str(next(self._ids)),
+				"method": method,
+				"params": params,
+			}
+		).encode()
+		request = urllib.request.Request(
+			self.url, data=payload, headers={"Content-Type": "application/json"}
+		)
+		try:
+			with self._opener.open(request, timeout=30) as response:
+				body = json.load(response)
+		except urllib.error.HTTPError as e:
+			# aria2 reports RPC errors with a non-200 status and a JSON body.
+			try:
+				body = json.load(e)
+			except ValueError:
+				raise Aria2RPCError(f"{method}: HTTP {e.code}") from e
+
+		if "error" in body:
+			raise Aria2RPCError(f"{method}: {body['error'].get('message')}")
+		return body["result"]
+
+
+def read_aria2_conf(filepath):
+	"""Parse an aria2 configuration file into an RPC options dict."""
+
+	options = dict()
+	try:
+		with open(filepath, "r") as file:
+			for line in file:
+				line = line.strip()
+				if not line or line.startswith("#") or "=" not in line:
+					continue
+				key, value = line.split("=", 1)
+				options[key.strip()] = value.strip()
+	except OSError as e:
+		logging.warning(f"Could not read aria2 config {filepath}: {e}")
+	return options
+
+
+def build_rpc_options(opts, defaults, proxy_vars):
+	options = dict()
+
+	# The daemon is started with the default conf; only a per-URL conf
+	# needs to be shipped along with the download.
+	if opts["conf"] != defaults["conf"]:
+		options.update(read_aria2_conf(os.path.expanduser(opts["conf"])))
+
+	options["dir"] = opts["dir"]
+	if opts["out"]:
+		options["out"] = opts["out"]
+	if opts["retry-file"]:
+		options["max-tries"] = str(opts["retry-file"])
+	if opts.get("continue"):
+		options["continue"] = "true"
+	if opts.get("max-connections"):
+		options["max-connection-per-server"] = str(opts["max-connections"])
+		options["split"] = str(opts["max-connections"])
+	if opts.get("max-speed"):
+		options["max-download-limit"] = str(opts["max-speed"])
+
+	if opts["proxify"]:
+		http_proxy = proxy_vars["HTTP_PROXY"] or proxy_vars["http_proxy"]
+		https_proxy = proxy_vars["HTTPS_PROXY"] or proxy_vars["https_proxy"]
+		if http_proxy:
+			options["http-proxy"] = http_proxy
+		if https_proxy:
+			options["https-proxy"] = https_proxy
+	else:
+		options.update({"all-proxy": "", "http-proxy": "", "https-proxy": ""})
+
+	return options
+
+
+def port_available(port):
+	with socket.socket() as sock:
+		try:
+			sock.bind(("127.0.0.1", port))
+		except OSError:
+			return False
+	return True
+
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+
+def start_aria2_daemon(defaults, workers, port):
+	cmd = [
+		"aria2c",
+		"--enable-rpc",
+		f"--rpc-listen-port={port}",
+		f"--max-concurrent-downloads={workers}",
+		"--console-log-level=warn",
+	]
+	if os.path.isfile(defaults["conf"]):
+		cmd.append(f"--conf-path={defaults['conf']}")
+	else:
+		cmd.append("--no-conf")
+	if defaults["rpc-secret"]:
+		cmd.append(f"--rpc-secret={defaults['rpc-secret']}")
+	if defaults["max-overall-speed"]:
+		cmd.append(f"--max-overall-download-limit={defaults['max-overall-speed']}")
+
+	logging.debug(f"Starting aria2c daemon :: {' '.join(cmd)}")
+	return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def connect_rpc(defaults, workers):
+	"""Returns the RPC client and the daemon process, if this script started one."""
+
+	daemon = None
+	url = defaults["rpc-url"]
+	if not url:
+		# Another aria2 on the port would answer in place of ours, and be shut
+		# down at the end.
+		port = defaults["rpc-port"]
+		if not port_available(port):
+			port = free_port()
+			logging.warning(
+				f"RPC port {defaults['rpc-port']} is in use,"
+				f" starting aria2c on port {port}"
+			)
+		daemon = start_aria2_daemon(defaults, workers, port)
+		url = f"http://127.0.0.1:{port}/jsonrpc"
+
+	rpc = Aria2RPC(url, defaults["rpc-secret"])
+	for _ in range(50):
+		try:
+			version = rpc.call("aria2.getVersion")
+			if daemon is not None and daemon.poll() is not None:
+				break
+			logging.debug(f"Connected to aria2 {version['version']} at {url}")
+			if daemon is None and defaults["max-overall-speed"]:
+				rpc.call(
+					"aria2.changeGlobalOption",
+					{"max-overall-download-limit": str(defaults["max-overall-speed"])},
+				)
+			return rpc, daemon
+		except (Aria2RPCError, OSError):
+			if daemon is not None and daemon.poll() is not None:
+				break
+			time.sleep(0.2)
+
+	if daemon is not None:
+		daemon.kill()
+	raise Aria2RPCError(f"aria2 RPC endpoint {url} is not reachable")
+
+
+def stop_aria2_daemon(rpc, daemon):
+	if daemon.poll() is not None:
+		return
+	logging.debug("Shutting down aria2c daemon")
+	try:
+		rpc.call("aria2.shutdown")
+		daemon.wait(timeout=30)
+	except (Aria2RPCError, OSError, subprocess.TimeoutExpired):
+		daemon.kill()
+
+
+def run_rpc_download(rpc, url, opts, defaults, proxy_vars, metrics):
+	options = build_rpc_options(opts, defaults, proxy_vars)
+	os.makedirs(opts["dir"], exist_ok=True)
+	logging.debug(f"Submitting download for :: {url} {options}")
+
+	gid = None
+	try:
+		gid = rpc.call("aria2.addUri", [url], options)
+		metrics.update(url, status="active")
+		last_summary = time.monotonic()
+		while True:
+			time.sleep(defaults["rpc-poll-interval"])
+			status = rpc.call("aria2.tellStatus", gid, RPC_STATUS_KEYS)
+			done, total = int(status["completedLength"]), int(status["totalLength"])
+			speed = int(status["downloadSpeed"])
+			metrics.update(
+				url,
+				**{
+					"bytes-done": done,
+					"bytes-total": total,
+					"speed": speed,
+					"eta": (total - done) // speed if speed else 0,
+					"connections": int(status["connections"]),
+				},
+			)
+			if status["status"] not in ("active", "waiting", "paused"):
+				break
+			if (
+				defaults["raw-output"]
+				and time.monotonic() - last_summary >= SUMMARY_INTERVAL
+			):
+				last_summary = time.monotonic()
+				print(
+					f"[#{gid} {done}/{total}B CN:{status['connections']}"
+					f" DL:{speed}B/s] {url}"
+				)
+		rpc.call("aria2.removeDownloadResult", gid)
+	except (Aria2RPCError, OSError) as e:
+		if gid is not None:
+			# Do not leave the transfer running unwatched in the daemon.
+			for method in ("aria2.forceRemove", "aria2.removeDownloadResult"):
+				try:
+					rpc.call(method, gid)
+				except (Aria2RPCError, OSError):
+					pass
+		metrics.finish(url, False)
+		logging.error(f"Download failed for {url} with RPC error: {e}")
+		return False
+
+	if status["status"] == "complete":
+		metrics.finish(url, True)
+		logging.debug(f"Download successful for {url}")
+		return True
+	else:
+		metrics.finish(url, False)
+		logging.error(
+			f"Download failed for {url} with error: {status.get('errorCode')}"
+			f" {status.get('errorMessage', '')}"
+		)
 		return False
 
 
@@ -120,7 +766,36 @@ def populate_defaults(defaults: dict):
 			defaults["base-dir"], f"{datetime.now().strftime("%Y-%m-%d--%H-%M-%S")}"
 		),
 	)
+	defaults.setdefault(
+		"journal",
+		os.path.join(os.path.dirname(defaults["log"]), "night-owl-journal.jsonl"),
+	)
+	defaults.setdefault(
+		"metrics-file",
+		os.path.join(os.path.dirname(defaults["log"]), "night-owl-metrics.json"),
+	)
+	defaults.setdefault("metrics-interval", SUMMARY_INTERVAL)
+	defaults.setdefault("raw-output", False)
+	defaults.setdefault("probe", False)
+	defaults.setdefault("probe-workers", 16)
+	defaults.setdefault("order", "files")
+	defaults.setdefault("bandwidth", 0)
+	defaults["bandwidth"] = parse_speed(defaults["bandwidth"])
 	defaults.setdefault("retry", 1)
+	defaults.setdefault("backoff-base", 30)
+	defaults.setdefault("backoff-max", 900)
+	defaults.setdefault("max-concurrent", 1)
+	defaults.setdefault("max-overall-speed", 0)
+	defaults["max-overall-speed"] = parse_speed(defaults["max-overall-speed"])
+	defaults.setdefault("host-max-concurrent", 0)
+	defaults.setdefault("host-max-connections", 0)
+	defaults.setdefault("host-max-speed", 0)
+	defaults.setdefault("hosts", dict())
+	defaults.setdefault("engine", "process")
+	defaults.setdefault("rpc-url", "")
+	defaults.setdefault("rpc-port", 6800)
+	defaults.setdefault("rpc-secret", "")
+	defaults.setdefault("rpc-poll-interval", 1)
 	defaults.setdefault("proxify", True)
 
 	defaults.setdefault("conf", "~/.aria2c")
@@ -137,82 +812,467 @@ def populate_defaults(defaults: dict):
 		defaults["end-time"] = datetime.strptime(defaults["end-time"], "%H:%M").time()
 
 
-def resolve_opts(defaults: dict, values: dict) -> dict:
+def resolve_opts(defaults: dict, spec: UrlSpec) -> dict:
 	opts = dict()
 
-	if "dir" in values and values["dir"]:
-		opts["dir"] = os.path.join(defaults["base-dir"], values["dir"])
+	if spec.dir:
+		opts["dir"] = os.path.join(defaults["base-dir"], spec.dir)
 	else:
 		opts["dir"] = defaults["base-dir"]
 
-	opts["out"] = values.get("out", "")
-	opts["conf"] = values.get("conf", defaults["conf"])
-	opts["retry-file"] = values.get("retry-file", "")
-	opts["proxify"] = values.get("proxify", defaults["proxify"])
+	opts["out"] = spec.out
+	opts["conf"] = spec.conf or defaults["conf"]
+	opts["retry-file"] = spec.retry_file or ""
+	opts["proxify"] = defaults["proxify"] if spec.proxify is None else spec.proxify
 
 	return opts
 
 
+def parse_speed(value) -> int:
+	"""Converts aria2 style speeds such as `500K` or `2M` to bytes per second."""
+
+	if not value:
+		return 0
+	value = str(value).strip().upper()
+	units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+	if value[-1] in units:
+		return int(float(value[:-1]) * units[value[-1]])
+	return int(value)
+
+
+def host_limits(defaults: dict, host: str) -> dict:
+	limits = {
+		"max-concurrent": defaults["host-max-concurrent"],
+		"max-connections": defaults["host-max-connections"],
+		"max-speed": defaults["host-max-speed"],
+	}
+	limits.update(defaults["hosts"].get(host) or dict())
+	limits["max-speed"] = parse_speed(limits["max-speed"])
+	return limits
+
+
+def apply_limits(defaults: dict, opts: dict, host: str, spec: UrlSpec):
+	"""Sets the per-download connection and speed budget of a URL.
+
+	A host's connection and bandwidth budgets are split evenly between the
+	transfers it may run at once; per-URL values override the host's share.
+	"""
+
+	limits = host_limits(defaults, host)
+	slots = limits["max-concurrent"] or defaults["max-concurrent"]
+
+	connections = spec.max_connections
+	if not connections and limits["max-connections"]:
+		connections = max(1, limits["max-connections"] // slots)
+
+	speed = spec.max_speed
+	if not speed and limits["max-speed"]:
+		speed = max(1, limits["max-speed"] // slots)
+	# Separate aria2c processes cannot share the global cap, so give each
+	# worker its share of it. A daemon enforces the cap itself.
+	if defaults["max-overall-speed"] and defaults["engine"] == "process":
+		share = max(1, defaults["max-overall-speed"] // defaults["max-concurrent"])
+		speed = min(speed, share) if speed else share
+
+	opts["max-connections"] = connections or 0
+	opts["max-speed"] = speed
+
+
+class Journal:
+	"""Append-only JSONL record of download states, keyed by URL and options."""
+
+	def __init__(self, path):
+		self.path = path
+		self.state = dict()
+		self._lock = threading.Lock()
+
+		if path:
+			os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+			lines = self._replay()
+			# Keep replay cheap on long-lived journals by dropping superseded records.
+			if lines > 2 * len(self.state) + 100:
+				self._compact()
+			self._file = open(path, "a")
+		else:
+			self._file = None
+
+	@staticmethod
+	def key(url, opts):
+		digest = hashlib.sha1(json.dumps(opts, sort_keys=True).encode()).hexdigest()
+		return f"{url}#{digest[:16]}"
+
+	def _replay(self):
+		lines = 0
+		try:
+			with open(self.path, "r") as file:
+				for line in file:
+					lines += 1
+					try:
+						record = json.loads(line)
+						self.state[record["key"]] = record["status"]
+					except (ValueError, KeyError):
+						# A crash may leave a truncated last line behind.
+						continue
+		except FileNotFoundError:
+			pass
+		return lines
+
+	def _compact(self):
+		tmp_path = f"{self.path}.tmp"
+		with open(tmp_path, "w") as file:
+			for key, status in self.state.items():
+				file.write(json.dumps({"key": key, "status": status}) + "\n")
+		os.replace(tmp_path, self.path)
+
+	def status(self, key):
+		return self.state.get(key)
+
+	def record(self, key, status):
+		with self._lock:
+			self.state[key] = status
+			if self._file is None:
+				return
+			record = {"key": key, "status": status, "time": datetime.now().isoformat()}
+			self._file.write(json.dumps(record) + "\n")
+			self._file.flush()
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+
+
+def end_time_reached(defaults: dict) -> bool:
+	return bool(defaults["end-time"]) and datetime.now().time() > defaults["end-time"]
+
+
+def seconds_until_end(defaults: dict):
+	if not defaults["end-time"]:
+		return None
+	now = datetime.now()
+	end = datetime.combine(now.date(), defaults["end-time"])
+	if end < now:
+		end += timedelta(days=1)
+	return (end - now).total_seconds()
+
+
+class HeadRedirectHandler(urllib.request.HTTPRedirectHandler):
+	# urllib turns every redirect into a GET, which would start the download.
+	def redirect_request(self, req, fp, code, msg, headers, newurl):
+		request = super().redirect_request(req, fp, code, msg, headers, newurl)
+		if request is not None:
+			request.method = req.get_method()
+		return request
+
+
+def probe_url(url, opts, proxy_vars):
+	"""Returns the `Content-Length` (or None) and whether ranges are accepted."""
+
+	proxies = dict()
+	if opts["proxify"]:
+		proxies["http"] = proxy_vars["HTTP_PROXY"] or proxy_vars["http_proxy"]
+		proxies["https"] = proxy_vars["HTTPS_PROXY"] or proxy_vars["https_proxy"]
+	opener = urllib.request.build_opener(
+		urllib.request.ProxyHandler({k: v for k, v in proxies.items() if v}),
+		HeadRedirectHandler,
+	)
+
+	try:
+		request = urllib.request.Request(url, method="HEAD")
+		with opener.open(request, timeout=15) as response:
+			length = response.headers.get("Content-Length")
+			ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+			return (int(length) if length and length.isdigit() else None), ranges
+	except (OSError, ValueError) as e:
+		logging.debug(f"Probe failed for {url}: {e}")
+		return None, False
+
+
+def probe_entries(urls, pending, defaults, proxy_vars):
+	"""Probes the HTTP(S) URLs; FTP, SFTP and magnet URLs are left unsized."""
+
+	probed = [url for url in pending if urlparse(url).scheme in ("http", "https")]
+	for url in pending:
+		urls[url]["size"] = None
+		urls[url]["ranges"] = False
+
+	logging.debug(f"Probing {len(probed)} URLs")
+	with ThreadPoolExecutor(max_workers=defaults["probe-workers"]) as pool:
+		results = pool.map(
+			lambda url: probe_url(url, urls[url]["opts"], proxy_vars), probed
+		)
+		for url, (size, ranges) in zip(probed, results):
+			urls[url]["size"] = size
+			urls[url]["ranges"] = ranges
+
+
+def order_entries(urls, pending, defaults):
+	"""Orders probed URLs for the most completed files or bytes before end-time.
+
+	`files` runs the smallest downloads first. `bytes` packs the largest
+	downloads that fit into the time left at the expected bandwidth, and without
+	an end-time simply runs the largest first to keep the tail short. URLs of
+	unknown size keep their YAML order after the sized ones.
+	"""
+
+	sized = [url for url in pending if urls[url].get("size") is not None]
+	unsized = [url for url in pending if urls[url].get("size") is None]
+
+	if defaults["order"] == "files":
+		sized.sort(key=lambda url: urls[url]["size"])
+	elif defaults["order"] == "bytes":
+		sized.sort(key=lambda url: urls[url]["size"], reverse=True)
+		remaining = seconds_until_end(defaults)
+		if remaining is not None and defaults["bandwidth"]:
+			budget = remaining * defaults["bandwidth"]
+			packed, rest = list(), list()
+			for url in sized:
+				if urls[url]["size"] <= budget:
+					budget -= urls[url]["size"]
+					packed.append(url)
+				else:
+					rest.append(url)
+			sized = packed + rest
+	else:
+		return pending
+
+	return sized + unsized
+
+
+def fits_before_end(entry, defaults, bandwidth) -> bool:
+	"""Whether the transfer is worth starting before end-time.
+
+	A server that accepts ranges lets a cut-off transfer resume with --continue
+	on the next run, so only downloads that would have to start over are held.
+	"""
+
+	remaining = seconds_until_end(defaults)
+	if remaining is None or not bandwidth or entry.get("size") is None:
+		return True
+	if entry.get("ranges"):
+		return True
+	return entry["size"] / bandwidth <= remaining
+
+
+def download_worker(url, entry, defaults, proxy_vars, journal, metrics, rpc=None):
+	opts = entry["opts"]
+	journal.record(entry["key"], "started")
+	if rpc is not None:
+		result = run_rpc_download(rpc, url, opts, defaults, proxy_vars, metrics)
+	else:
+		env = build_env(opts, proxy_vars)
+		result = run_download(url, opts, metrics, env, defaults["raw-output"])
+	journal.record(entry["key"], "success" if result else "failed")
+
+	# Whatever happened, a partial file may now exist on disk.
+	opts["continue"] = True
+	return result
+
+
+def prepare_entries(specs, defaults, journal):
+	"""Returns the per-URL run state and the URLs still to download."""
+
+	urls, pending, completed = dict(), list(), 0
+	for spec in specs:
+		opts = resolve_opts(defaults, spec)
+		host = urlparse(spec.url).hostname or ""
+		key = Journal.key(spec.url, opts)
+		apply_limits(defaults, opts, host, spec)
+		urls[spec.url] = {"opts": opts, "key": key, "attempts": 0, "host": host}
+
+		previous = journal.status(key)
+		if previous == "success":
+			urls[spec.url]["status"] = "success"
+			completed += 1
+			continue
+		elif previous is not None:
+			logging.debug(f"Resuming {spec.url} (journal status: {previous})")
+			opts["continue"] = True
+
+		pending.append(spec.url)
+
+	if completed:
+		logging.debug(f"Skipping {completed} URLs already completed")
+	return urls, pending
+
+
+def backoff_delay(defaults, attempts):
+	delay = min(defaults["backoff-max"], defaults["backoff-base"] * 2 ** (attempts - 1))
+	# Equal jitter keeps URLs of one flaky host from retrying in lockstep.
+	return random.uniform(delay / 2, delay)
+
+
+def run_scheduler(specs, defaults, proxy_vars, workers, journal, metrics, rpc=None):
+	"""Runs downloads as slots free up; failed URLs re-enter the queue after a backoff.
+
+	URLs wait in a heap of (next eligible time, sequence, url) until they are
+	eligible, then move to a per-host ready queue. A free slot goes to the host
+	with the fewest running transfers that is still under its `max-concurrent`,
+	so hosts are interleaved and a URL waiting out its backoff never blocks the
+	ones behind it.
+	"""
+
+	urls, pending = prepare_entries(specs, defaults, journal)
+	if defaults["probe"]:
+		probe_entries(urls, pending, defaults, proxy_vars)
+		pending = order_entries(urls, pending, defaults)
+
+	sequence = itertools.count()
+	waiting = [(0.0, next(sequence), url) for url in pending]
+	heapq.heapify(waiting)
+	bandwidth = defaults["bandwidth"]
+	ready = dict()
+	active = collections.Counter()
+	limits = {
+		urls[url]["host"]: host_limits(defaults, urls[url]["host"])["max-concurrent"]
+		for _, _, url in waiting
+	}
+	running = dict()
+
+	def next_ready_url():
+		candidates = [
+			(active[host], queue[0][0], host)
+			for host, queue in ready.items()
+			if not limits[host] or active[host] < limits[host]
+		]
+		if not candidates:
+			return None
+		_, _, host = min(candidates)
+		_, url = ready[host].popleft()
+		if not ready[host]:
+			del ready[host]
+		return url
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		while waiting or ready or running:
+			if (waiting or ready) and end_time_reached(defaults):
+				logging.debug("End time reached. Not starting any more downloads.")
+				waiting.clear()
+				ready.clear()
+
+			now = time.monotonic()
+			while waiting and waiting[0][0] <= now:
+				_, seq, url = heapq.heappop(waiting)
+				host = urls[url]["host"]
+				ready.setdefault(host, collections.deque()).append((seq, url))
+
+			while len(running) < workers:
+				url = next_ready_url()
+				if url is None:
+					break
+				entry = urls[url]
+				# Running transfers share the link with the one about to start.
+				if not fits_before_end(entry, defaults, bandwidth / (len(running) + 1)):
+					logging.debug(f"Deferring {url}, it cannot finish before end-time")
+					entry["status"] = "deferred"
+					continue
+				entry["attempts"] += 1
+				active[entry["host"]] += 1
+				logging.debug(f"--- Starting try number {entry['attempts']} for {url}")
+				future = pool.submit(
+					download_worker,
+					url,
+					entry,
+					defaults,
+					proxy_vars,
+					journal,
+					metrics,
+					rpc,
+				)
+				running[future] = url
+
+			timeout = None
+			if waiting and len(running) < workers:
+				timeout = max(0.0, waiting[0][0] - now)
+			if not running:
+				if waiting:
+					time.sleep(timeout)
+				continue
+
+			done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+			speed = metrics.speed()
+			if speed:
+				bandwidth = 0.7 * bandwidth + 0.3 * speed if bandwidth else speed
+			for future in done:
+				url = running.pop(future)
+				entry = urls[url]
+				active[entry["host"]] -= 1
+				if future.result():
+					entry["status"] = "success"
+				elif entry["attempts"] < defaults["retry"]:
+					entry["status"] = "failed"
+					delay = backoff_delay(defaults, entry["attempts"])
+					logging.debug(f"Retrying {url} in {delay:.0f}s")
+					heapq.heappush(
+						waiting, (time.monotonic() + delay, next(sequence), url)
+					)
+				else:
+					entry["status"] = "failed"
+					logging.error(f"Giving up on {url} after {entry['attempts']} tries")
+
+	statuses = [entry.get("status", "pending") for entry in urls.values()]
+	logging.debug(
+		f"Finished: {statuses.count('success')} successful,"
+		f" {statuses.count('failed')} failed, {statuses.count('deferred')} deferred,"
+		f" {statuses.count('pending')} not started."
+	)
+
+
 def main():
 	args = parse_args()
 	yaml_path = args.yaml_path
-	urls = load_yaml(yaml_path)
+	defaults, specs, errors = compile_config(yaml_path, use_cache=not args.no_cache)
+
+	if args.check:
+		for error in errors:
+			print(error, file=sys.stderr)
+		print(f"{len(specs)} valid and {len(errors)} invalid entries.")
+		sys.exit(1 if errors else 0)
 
-	defaults = urls.get("defaults", dict())
-	if "defaults" in urls:
-		del urls["defaults"]
 	populate_defaults(defaults)
+	if args.max_concurrent:
+		defaults["max-concurrent"] = args.max_concurrent
+	if args.engine:
+		defaults["engine"] = args.engine
+	if args.rpc_url:
+		defaults["rpc-url"] = args.rpc_url
+		defaults["engine"] = "rpc"
+	if args.rpc_secret:
+		defaults["rpc-secret"] = args.rpc_secret
+	if args.journal is not None:
+		defaults["journal"] = args.journal
+	if args.raw_output:
+		defaults["raw-output"] = True
+	if args.probe:
+		defaults["probe"] = True
 
 	proxy_vars = dict()
 	for var in ["HTTP_PROXY", "http_proxy", "HTTPS_PROXY", "https_proxy"]:
 		proxy_vars[var] = os.environ.get(var, "")
 
 	setup_logging(defaults["log"])
+	for error in errors:
+		logging.error(f"Invalid entry :: {error}")
 
 	while defaults["start-time"] and datetime.now().time() < defaults["start-time"]:
 		time.sleep(30)
 
-	for tc in range(defaults["retry"]):
-		logging.debug(f"--- Starting try number {tc}")
-		success = True
-		for url in urls:
-			if isinstance(urls[url], dict) and "opts" in urls[url]:
-				opts = urls[url]["opts"]
-			else:
-				if isinstance(urls[url], str):
-					urls[url] = {"dir": urls[url]}
-				elif not isinstance(urls[url], dict):
-					logging.error(f"Invalid options for URL {url}: {urls[url]}")
-					urls[url] = {"status": "invalid"}
-					continue
+	workers = max(1, int(defaults["max-concurrent"]))
+	logging.debug(f"Running up to {workers} downloads at a time")
 
-				opts = resolve_opts(defaults, urls[url])
-				urls[url]["opts"] = opts
-
-			for var in proxy_vars:
-				if opts["proxify"]:
-					os.environ[var] = proxy_vars[var]
-				elif var in os.environ:
-					del os.environ[var]
-
-			if defaults["end-time"] and datetime.now().time() > defaults["end-time"]:
-				logging.debug("End time reached. Exiting.")
-				return
-
-			if run_download(url, opts):
-				urls[url]["status"] = "success"
-			else:
-				urls[url]["status"] = "failed"
-				success = False
-
-		if success:
-			logging.debug("All downloads successful.")
-			break
-		else:
-			logging.debug("Retrying downloads...")
-			time.sleep(30)
+	journal = Journal(defaults["journal"])
+	metrics = Metrics(defaults["metrics-file"], defaults["metrics-interval"])
+	rpc, daemon = None, None
+	if defaults["engine"] == "rpc":
+		rpc, daemon = connect_rpc(defaults, workers)
 
-	logging.debug("Finished all retries.")
+	metrics.start()
+	try:
+		run_scheduler(specs, defaults, proxy_vars, workers, journal, metrics, rpc)
+	finally:
+		metrics.stop()
+		journal.close()
+		if daemon is not None:
+			stop_aria2_daemon(rpc, daemon)
 
 
 if __name__ == "__main__":
@@ -2,11 +2,21 @@
 
 import os
 import re
+import json
+import queue
+import heapq
+import hashlib
 import ftplib
+import fnmatch
 import logging
 import argparse
+import posixpath
+import threading
+import time
 
-from typing import List, Tuple
+from typing import Callable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 
 def setup_logging():
@@ -32,6 +42,28 @@ def parse_arguments():
     parser.add_argument(
         "-r", "--recursive", action="store_true", help="Recursively search directories"
     )
+    parser.add_argument(
+        "-i",
+        "--include",
+        type=str,
+        action="append",
+        default=list(),
+        help="Only upload files whose relative path matches this glob",
+    )
+    parser.add_argument(
+        "-e",
+        "--exclude",
+        type=str,
+        action="append",
+        default=list(),
+        help="Skip files and directories whose relative path matches this glob",
+    )
+    parser.add_argument(
+        "--scan-jobs",
+        type=int,
+        default=1,
+        help="Number of threads scanning subdirectories in parallel",
+    )
     parser.add_argument("--ftp-server", type=str, required=True, help="FTP server address")
     parser.add_argument("--ftp-port", type=int, default=3721, help="FTP server port")
     parser.add_argument("--ftp-user", type=str, default="francis", help="FTP username")
@@ -39,6 +71,97 @@ def parse_arguments():
     parser.add_argument(
         "--remote-dir", type=str, required=True, help="Remote directory on FTP server"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of parallel FTP connections to upload with",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=256 * 1024,
+        help="Bytes per send on the data connection",
+    )
+    parser.add_argument(
+        "--sendfile",
+        action="store_true",
+        help="Send file data with sendfile(2) instead of read/send",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Print a throughput report (control vs data time, slowest files)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue partial remote files from their current size (REST/APPE)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Reconnect and retry this many times when a connection drops",
+    )
+    parser.add_argument(
+        "--timeout", type=int, default=60, help="FTP socket timeout in seconds"
+    )
+    parser.add_argument(
+        "--order",
+        choices=["scan", "largest", "smallest"],
+        default="scan",
+        help="Upload in scan order (streaming) or sorted by size after a full scan",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the transfer plan and estimated time without uploading",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=str,
+        help="Per-connection bytes/s for estimates, e.g. 40M (default: last measured)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Skip or server-side copy files whose content was already uploaded",
+    )
+    parser.add_argument(
+        "--dedup-db",
+        type=str,
+        default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "cpftp-dedup.json",
+        ),
+        help="Where file hashes and uploaded contents are remembered between runs",
+    )
+    parser.add_argument(
+        "--hash-jobs",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help="Number of threads hashing files for --dedup",
+    )
+    parser.add_argument(
+        "--dedup-rename",
+        action="store_true",
+        help=(
+            "With --dedup, move a remote file whose local original is gone to its"
+            " duplicate's path"
+        ),
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Skip files whose remote copy has the same size and is not older",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        help="JSON record of uploaded files; with --sync it replaces remote listings",
+    )
 
     args = parser.parse_args()
     if not args.path:
@@ -47,103 +170,913 @@ def parse_arguments():
     return args
 
 
-def connect_to_ftp(server: str, port: int, username: str, password: str) -> ftplib.FTP:
+class BinaryFTP(ftplib.FTP):
+    """An `ftplib.FTP` that remembers whether the session is in binary mode.
+
+    Listings switch the session to ASCII, where data would be mangled and many
+    servers refuse SIZE, so TYPE I is only sent again after one of those.
+    """
+
+    binary = False
+
+    def putcmd(self, line: str):
+        if line.startswith("TYPE "):
+            self.binary = False
+        super().putcmd(line)
+
+    def binary_mode(self):
+        if not self.binary:
+            self.voidcmd("TYPE I")
+            self.binary = True
+
+
+def connect_to_ftp(
+    server: str, port: int, username: str, password: str, timeout: Optional[int] = None
+) -> BinaryFTP:
     logger.info(f"Connecting to FTP server {server}:{port}")
-    ftp = ftplib.FTP()
-    ftp.connect(server, port)
+    ftp = BinaryFTP()
+    ftp.connect(server, port, timeout=timeout)
     ftp.login(username, password)
     ftp.set_pasv(True)
-    ftp.voidcmd("TYPE I")
+    ftp.binary_mode()
     return ftp
 
 
-def get_file_info(file_path: str) -> Tuple[str, str]:
-    filename = os.path.basename(file_path)
-    _, file_extension = os.path.splitext(filename)
-    return filename, file_extension.lstrip(".")
+def absolute_remote_path(remote_path: str) -> str:
+    return posixpath.normpath("/" + remote_path.replace("\\", "/").lstrip("/"))
+
+
+class RemoteDirectories:
+    """Remote directories known to exist, shared by all connections of a run.
+
+    Each missing directory costs a single MKD, and paths are always absolute so
+    the connections never have to change their working directory.
+    """
+
+    def __init__(self):
+        self.known = {"/"}
+        self._lock = threading.Lock()
+        self._seeded = False
+
+    def _add(self, path: str):
+        while path not in self.known:
+            self.known.add(path)
+            path = posixpath.dirname(path)
 
+    def seed(self, ftp: ftplib.FTP, remote_dir: str):
+        """Learns `remote_dir` and its subdirectories from one MLSD listing."""
 
-def create_remote_directory(ftp: ftplib.FTP, remote_path: str):
-    dirs = remote_path.split("/")
-    for dir in dirs:
-        if dir:
+        path = absolute_remote_path(remote_dir)
+        with self._lock:
+            if self._seeded:
+                return
+            self._seeded = True
             try:
-                ftp.cwd(dir)
+                entries = list(ftp.mlsd(path, facts=["type"]))
             except ftplib.error_perm:
-                logger.info(f"Creating remote directory: {dir}")
-                ftp.mkd(dir)
-                ftp.cwd(dir)
-    ftp.cwd("/")
+                # Either MLSD is unsupported or the directory does not exist yet.
+                return
+            self._add(path)
+            for name, facts in entries:
+                if facts.get("type") == "dir":
+                    self.known.add(posixpath.join(path, name))
+        logger.info(f"Found {len(self.known)} existing remote directories")
+
+    def ensure(self, ftp: ftplib.FTP, remote_path: str):
+        path = absolute_remote_path(remote_path)
+        if path in self.known:
+            return
+
+        with self._lock:
+            missing = list()
+            while path not in self.known:
+                missing.append(path)
+                path = posixpath.dirname(path)
+            for path in reversed(missing):
+                try:
+                    ftp.mkd(path)
+                    logger.info(f"Creating remote directory: {path}")
+                except ftplib.error_perm:
+                    # The directory already exists.
+                    pass
+                self.known.add(path)
+
+
+def parse_mlsd_time(value: str) -> float:
+    # MLSD times are UTC, formatted as YYYYMMDDHHMMSS[.sss].
+    moment = datetime.strptime(value[:14], "%Y%m%d%H%M%S")
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+
+class RemoteListing:
+    """Sizes and modification times of remote files, one MLSD per directory."""
+
+    def __init__(self):
+        self.listings = dict()
+        self._lock = threading.Lock()
+
+    def stat(self, ftp: ftplib.FTP, remote_path: str) -> Optional[Tuple[int, float]]:
+        directory, name = posixpath.split(remote_path)
+        with self._lock:
+            if directory not in self.listings:
+                try:
+                    self.listings[directory] = {
+                        entry: facts
+                        for entry, facts in ftp.mlsd(
+                            directory, ["type", "size", "modify"]
+                        )
+                        if facts.get("type") == "file"
+                    }
+                except ftplib.error_perm:
+                    # A missing directory, or a server without MLSD.
+                    self.listings[directory] = dict()
+
+        facts = self.listings[directory].get(name)
+        if not facts or "size" not in facts or "modify" not in facts:
+            return None
+        return int(facts["size"]), parse_mlsd_time(facts["modify"])
+
+
+class Manifest:
+    """Size and mtime of every local file uploaded, keyed by remote path."""
 
+    def __init__(self, path: str):
+        self.path = path
+        self.files = dict()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                self.files = json.load(file)
+
+    def stat(self, remote_path: str) -> Optional[Tuple[int, float]]:
+        return self.files.get(remote_path)
+
+    def record(self, remote_path: str, local_path: str):
+        stat = os.stat(local_path)
+        with self._lock:
+            self.files[remote_path] = (stat.st_size, stat.st_mtime)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.files, file)
+        os.replace(tmp_path, self.path)
+
+
+def remote_size(ftp: BinaryFTP, remote_file: str) -> Optional[int]:
+    """Returns the size of a remote file, or None if it does not exist."""
+
+    ftp.binary_mode()
+    try:
+        return ftp.size(remote_file)
+    except ftplib.error_perm as e:
+        if str(e).startswith("550"):
+            return None
+        raise
+
+
+def store(
+    ftp: BinaryFTP,
+    command: str,
+    file,
+    rest: Optional[int] = None,
+    block_size: int = 8192,
+    use_sendfile: bool = False,
+) -> float:
+    """Like `ftp.storbinary`, with a choice of send path.
+
+    Returns the seconds spent sending.
+    """
+
+    ftp.binary_mode()
+    with ftp.transfercmd(command, rest) as conn:
+        start = time.perf_counter()
+        if use_sendfile:
+            conn.sendfile(file, file.tell())
+        else:
+            buffer = bytearray(block_size)
+            view = memoryview(buffer)
+            while size := file.readinto(buffer):
+                conn.sendall(view[:size])
+        data_time = time.perf_counter() - start
+    ftp.voidresp()
+    return data_time
+
+
+def upload_file(
+    ftp: BinaryFTP,
+    local_file: str,
+    remote_file: str,
+    offset: int = 0,
+    block_size: int = 8192,
+    use_sendfile: bool = False,
+) -> float:
+    if not offset:
+        logger.info(f"Uploading: {local_file} to {remote_file}")
+    else:
+        logger.info(f"Resuming: {local_file} to {remote_file} from byte {offset}")
 
-def upload_file(ftp: ftplib.FTP, local_file: str, remote_file: str):
-    logger.info(f"Uploading: {local_file} to {remote_file}")
     with open(local_file, "rb") as file:
-        ftp.storbinary(f"STOR {remote_file}", file)
-
-
-# TODO: support relative paths and resolve them for absolutes
-def process_directory(
-    ftp: ftplib.FTP,
-    local_dir: str,
-    remote_dir: str,
-    formats: List[str],
-    recursive: bool,
-):
-    for item in os.listdir(local_dir):
-        local_path = os.path.join(local_dir, item)
-        remote_path = os.path.join(remote_dir, item).replace("\\", "/")
-
-        logger.info(f"{local_path} -> {remote_path}")
-        if os.path.isfile(local_path):
-            _, file_format = get_file_info(local_path)
-            if not formats or file_format in formats:
-                create_remote_directory(ftp, os.path.dirname(remote_path))
-                upload_file(ftp, local_path, remote_path)
-        elif os.path.isdir(local_path) and recursive:
-            logger.info(f"Entering directory: {local_path}")
-            create_remote_directory(ftp, remote_path)
-            process_directory(ftp, local_path, remote_path, formats, recursive)
-
-def process_directory(
-    ftp: ftplib.FTP,
-    local_dir: str,
-    remote_dir: str,
-    formats: List[str],
-    recursive: bool,
-    base_dir: str,
-):
-    for root, dirs, files in os.walk(local_dir):
-        for file in files:
-            local_path = os.path.join(root, file)
-            _, file_format = get_file_info(local_path)
-            
-            if not formats or file_format in formats:
-                relative_path = os.path.relpath(local_path, base_dir)
-                remote_path = os.path.join(remote_dir, relative_path).replace("\\", "/")
-
-                create_remote_directory(ftp, os.path.dirname(remote_path))
-                upload_file(ftp, local_path, remote_path)
-        
-        if not recursive:
+        file.seek(offset)
+        if not offset:
+            return store(
+                ftp, f"STOR {remote_file}", file, None, block_size, use_sendfile
+            )
+        try:
+            return store(
+                ftp, f"STOR {remote_file}", file, offset, block_size, use_sendfile
+            )
+        except ftplib.error_perm as e:
+            # Servers that refuse REST before STOR can still append.
+            logger.info(f"REST refused ({e}), appending instead")
+            file.seek(offset)
+            return store(
+                ftp, f"APPE {remote_file}", file, None, block_size, use_sendfile
+            )
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
             break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+def parse_size(value: str) -> int:
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+BANDWIDTH_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "cpftp.json"
+)
+
+
+def load_bandwidth(server: str) -> Optional[dict]:
+    try:
+        with open(BANDWIDTH_FILE, "r") as file:
+            return json.load(file).get(server)
+    except (OSError, ValueError):
+        return None
+
+
+def save_bandwidth(server: str, measured: dict):
+    try:
+        with open(BANDWIDTH_FILE, "r") as file:
+            servers = json.load(file)
+    except (OSError, ValueError):
+        servers = dict()
+    servers[server] = measured
+    os.makedirs(os.path.dirname(BANDWIDTH_FILE), exist_ok=True)
+    with open(BANDWIDTH_FILE, "w") as file:
+        json.dump(servers, file)
+
+
+class TransferStats:
+    """Per-file bytes and time spent on data transfer versus control commands."""
+
+    def __init__(self):
+        self.files = list()
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, local_path: str, size: int, total_time: float, data_time: float):
+        with self._lock:
+            self.files.append((local_path, size, total_time, data_time))
+
+    def measured(self) -> Optional[dict]:
+        """Per-connection data rate and per-file command overhead of this run."""
+
+        data_time = sum(data for _, _, _, data in self.files)
+        if not self.files or data_time <= 0:
+            return None
+        total_bytes = sum(size for _, size, _, _ in self.files)
+        control_time = sum(total - data for _, _, total, data in self.files)
+        return {
+            "bytes_per_second": total_bytes / data_time,
+            "seconds_per_file": control_time / len(self.files),
+        }
+
+    def report(self, slowest: int = 5):
+        wall_time = time.perf_counter() - self.started
+        total_bytes = sum(size for _, size, _, _ in self.files)
+        data_time = sum(data for _, _, _, data in self.files)
+        control_time = sum(total - data for _, _, total, data in self.files)
+
+        logger.info(
+            f"Uploaded {len(self.files)} files, {format_size(total_bytes)} in"
+            f" {wall_time:.1f}s ({format_size(total_bytes / max(wall_time, 1e-9))}/s)"
+        )
+        logger.info(
+            f"Connection time: {data_time:.1f}s sending data,"
+            f" {control_time:.1f}s in control commands"
+        )
+
+        def throughput(record):
+            _, size, total_time, _ = record
+            return size / max(total_time, 1e-9)
+
+        if self.files:
+            logger.info("Slowest files:")
+        for record in sorted(self.files, key=throughput)[:slowest]:
+            local_path, size, total_time, data_time = record
+            logger.info(
+                f"  {format_size(throughput(record))}/s  {format_size(size)}"
+                f"  control {total_time - data_time:.2f}s  {local_path}"
+            )
+
+
+def resume_offset(ftp: BinaryFTP, local_file: str, remote_file: str) -> Optional[int]:
+    """Returns where to continue uploading, or None when the remote file is complete."""
+
+    size = remote_size(ftp, remote_file)
+    local_size = os.path.getsize(local_file)
+    if size is None:
+        # Not there yet; even an empty file has to be created.
+        return 0
+    if size == local_size:
+        return None
+    # A larger remote file is not a prefix of ours; start over.
+    return size if size < local_size else 0
+
+
+class UploadPool:
+    """Uploads files over `jobs` FTP connections, each owned by one worker thread."""
+
+    def __init__(self, args: argparse.Namespace, jobs: int):
+        self.args = args
+        self.tasks = queue.Queue(maxsize=jobs * 4)
+        self.failed = list()
+        self.skipped = 0
+        self.directories = RemoteDirectories()
+        self.listing = RemoteListing()
+        self.manifest = Manifest(args.manifest) if args.manifest else None
+        self.stats = TransferStats()
+        self._lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"ftp-{i}", daemon=True)
+            for i in range(jobs)
+        ]
+
+    def __enter__(self):
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for _ in self._workers:
+            self.tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def submit(self, local_path: str, remote_path: str):
+        self.tasks.put((local_path, remote_path))
+
+    def _connect(self) -> ftplib.FTP:
+        ftp = connect_to_ftp(
+            self.args.ftp_server,
+            self.args.ftp_port,
+            self.args.ftp_user,
+            self.args.ftp_pass,
+            self.args.timeout,
+        )
+        self.directories.seed(ftp, self.args.remote_dir)
+        return ftp
+
+    def _upload(self, ftp: ftplib.FTP, local_path: str, remote_path: str):
+        start = time.perf_counter()
+        if self._unchanged(ftp, local_path, remote_path):
+            logger.info(f"Unchanged, skipping: {local_path}")
+            with self._lock:
+                self.skipped += 1
+            return
+
+        self.directories.ensure(ftp, posixpath.dirname(remote_path))
+        offset = 0
+        if self.args.resume:
+            offset = resume_offset(ftp, local_path, remote_path)
+            if offset is None:
+                logger.info(f"Already complete on the server: {local_path}")
+        if offset is not None:
+            data_time = upload_file(
+                ftp,
+                local_path,
+                remote_path,
+                offset,
+                self.args.block_size,
+                self.args.sendfile,
+            )
+            size = os.path.getsize(local_path) - offset
+            self.stats.record(local_path, size, time.perf_counter() - start, data_time)
+        if self.manifest is not None:
+            self.manifest.record(remote_path, local_path)
+
+    def _work(self):
+        ftp = None
+        try:
+            while (task := self.tasks.get()) is not None:
+                local_path, remote_path = task
+                remote_path = absolute_remote_path(remote_path)
+                for attempt in range(self.args.retries + 1):
+                    try:
+                        if ftp is None:
+                            ftp = self._connect()
+                        self._upload(ftp, local_path, remote_path)
+                        break
+                    except (ftplib.error_perm, FileNotFoundError, PermissionError) as e:
+                        logger.error(f"Failed to upload {local_path}: {e}")
+                        self._fail(local_path)
+                        break
+                    except ftplib.all_errors as e:
+                        if ftp is not None:
+                            ftp.close()
+                            ftp = None
+                        if attempt == self.args.retries:
+                            logger.error(f"Failed to upload {local_path}: {e}")
+                            self._fail(local_path)
+                        else:
+                            delay = min(30, 2**attempt)
+                            reason = e or type(e).__name__
+                            logger.warning(
+                                f"Connection lost ({reason}), retrying in {delay}s"
+                            )
+                            time.sleep(delay)
+                    except Exception as e:
+                        # E.g. ftplib refusing a newline in a file name. Keep the
+                        # worker alive, or submit() would block on a full queue.
+                        logger.error(f"Failed to upload {local_path}: {e!r}")
+                        self._fail(local_path)
+                        if ftp is not None:
+                            ftp.close()
+                            ftp = None
+                        break
+        finally:
+            if ftp is not None:
+                logger.info("Closing FTP connection")
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    ftp.close()
+
+    def _unchanged(self, ftp: ftplib.FTP, local_path: str, remote_path: str) -> bool:
+        if not self.args.sync:
+            return False
+        if self.manifest is not None:
+            previous = self.manifest.stat(remote_path)
+        else:
+            previous = self.listing.stat(ftp, remote_path)
+        if previous is None:
+            return False
+
+        stat = os.stat(local_path)
+        size, mtime = previous
+        return size == stat.st_size and mtime >= int(stat.st_mtime)
+
+    def _fail(self, local_path: str):
+        with self._lock:
+            self.failed.append(local_path)
+
+
+def hash_file(path: str, block_size: int = 1024 * 1024) -> str:
+    # BLAKE2 is fast in pure hashlib and releases the GIL on large buffers.
+    digest = hashlib.blake2b(digest_size=20)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as file:
+        while size := file.readinto(buffer):
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def server_copy(ftp: ftplib.FTP, source: str, target: str):
+    # mod_copy style SITE CPFR/CPTO, supported by ProFTPD and a few others.
+    ftp.sendcmd(f"SITE CPFR {source}")
+    ftp.voidcmd(f"SITE CPTO {target}")
+
+
+class Deduplicator:
+    """Sends each distinct file content to the server only once.
+
+    Files are hashed on a thread pool, with hashes cached by device, inode, size
+    and mtime. The first file with a given hash is forwarded to the upload pool;
+    later ones, and contents uploaded by earlier runs, are placed with a
+    server-side copy after the uploads finish, or skipped when the server cannot
+    do that. A duplicate whose original is not on the server, because it failed
+    to upload or was overwritten since, is uploaded itself.
+    """
+
+    def __init__(self, args: argparse.Namespace, forward: Callable[[str, str], None]):
+        self.path = args.dedup_db
+        self.rename = args.dedup_rename
+        self.server = f"{args.ftp_server}:{args.ftp_port}"
+        self.forward = forward
+        self.claimed = dict()
+        self.duplicates = list()
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, args.hash_jobs))
+
+        try:
+            with open(self.path, "r") as file:
+                db = json.load(file)
+        except (OSError, ValueError):
+            db = dict()
+        self.hashes = db.get("hashes", dict())
+        self.servers = db.get("uploaded", dict())
+        self.uploaded = self.servers.setdefault(self.server, dict())
+        # Remote path -> digest of the content it holds, or will once uploaded.
+        self.paths = {remote: digest for digest, (_, remote) in self.uploaded.items()}
+
+    def submit(self, local_path: str, remote_path: str):
+        self._executor.submit(self._route, local_path, remote_path)
+
+    def wait(self):
+        self._executor.shutdown(wait=True)
+
+    def _hash(self, local_path: str) -> str:
+        stat = os.stat(local_path)
+        key = f"{stat.st_dev}:{stat.st_ino}"
+        cached = self.hashes.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hash_file(local_path)
+        with self._lock:
+            self.hashes[key] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def _route(self, local_path: str, remote_path: str):
+        try:
+            digest = self._hash(local_path)
+        except OSError as e:
+            logger.error(f"Could not hash {local_path}: {e}")
+            return
+
+        target = absolute_remote_path(remote_path)
+        with self._lock:
+            # Whatever an earlier run uploaded there is about to be replaced,
+            # whether by an upload or by a copy.
+            stale = self.paths.get(target)
+            if stale is not None and stale != digest:
+                self.uploaded.pop(stale, None)
+            self.paths[target] = digest
+            original = self.claimed.get(digest) or self.uploaded.get(digest)
+            if original is None:
+                self.claimed[digest] = (local_path, target)
+            else:
+                self.duplicates.append((digest, local_path, target, *original))
+        if original is None:
+            self.forward(local_path, remote_path)
+
+    def place_duplicates(self, pool: "UploadPool"):
+        if not self.duplicates:
+            return
+
+        failed = set(pool.failed)
+        ftp = pool._connect()
+        can_copy = True
+        moved = dict()
+        try:
+            for (
+                digest,
+                local_path,
+                remote_path,
+                original_local,
+                original_remote,
+            ) in self.duplicates:
+                if digest in self.claimed:
+                    # May have been replaced by a duplicate uploaded in place of a
+                    # failed original.
+                    original_local, original_remote = self.claimed[digest]
+                if original_remote in moved:
+                    original_local, original_remote = moved[original_remote]
+                if original_local in failed or not self._intact(
+                    ftp, digest, local_path, original_remote
+                ):
+                    # The content is not on the server; send this copy instead.
+                    try:
+                        pool._upload(ftp, local_path, remote_path)
+                    except (ftplib.Error, OSError) as e:
+                        logger.error(f"Failed to upload {local_path}: {e}")
+                        pool._fail(local_path)
+                        failed.add(local_path)
+                        if not isinstance(
+                            e, (ftplib.error_perm, FileNotFoundError, PermissionError)
+                        ):
+                            ftp.close()
+                            ftp = pool._connect()
+                    else:
+                        self.claimed[digest] = (local_path, remote_path)
+                    continue
+
+                if remote_path == original_remote:
+                    logger.info(f"Already uploaded, skipping: {local_path}")
+                    continue
+                pool.directories.ensure(ftp, posixpath.dirname(remote_path))
+                try:
+                    if self.rename and not os.path.exists(original_local):
+                        # The file moved locally since it was uploaded; follow it.
+                        ftp.rename(original_remote, remote_path)
+                        logger.info(f"Renamed {original_remote} to {remote_path}")
+                        self._moved(original_remote, local_path, remote_path)
+                        moved[original_remote] = (local_path, remote_path)
+                    elif can_copy:
+                        server_copy(ftp, original_remote, remote_path)
+                        logger.info(
+                            f"Copied {original_remote} to {remote_path} on the server"
+                        )
+                    else:
+                        self.skipped += 1
+                        logger.warning(
+                            f"Duplicate of {original_remote}, skipping: {local_path}"
+                        )
+                except ftplib.error_perm as e:
+                    if str(e).startswith("50"):
+                        # Command not implemented; do not ask again.
+                        can_copy = False
+                    self.skipped += 1
+                    logger.warning(
+                        f"Duplicate of {original_remote}, skipping: {local_path} ({e})"
+                    )
+        finally:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+    def _intact(
+        self, ftp: ftplib.FTP, digest: str, local_path: str, original_remote: str
+    ) -> bool:
+        """Whether `original_remote` still holds the content of `local_path`."""
+        if self.paths.get(original_remote, digest) != digest:
+            # Overwritten with other content during this run.
+            return False
+        try:
+            return remote_size(ftp, original_remote) == os.path.getsize(local_path)
+        except (ftplib.error_perm, OSError):
+            return False
+
+    def _moved(self, original_remote: str, local_path: str, remote_path: str):
+        for digest, (_, uploaded_remote) in list(self.uploaded.items()):
+            if uploaded_remote == original_remote:
+                self.uploaded[digest] = (local_path, remote_path)
+        digest = self.paths.pop(original_remote, None)
+        if digest is not None:
+            self.paths[remote_path] = digest
+
+    def save(self, failed: List[str]):
+        failed = set(failed)
+        for digest, (local_path, remote_path) in self.claimed.items():
+            if local_path not in failed:
+                self.uploaded[digest] = (local_path, remote_path)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"hashes": self.hashes, "uploaded": self.servers}, file)
+        os.replace(tmp_path, self.path)
+
+
+def compile_filter(
+    formats: Optional[List[str]], include: List[str], exclude: List[str]
+) -> Tuple[Callable[[str], bool], Callable[[str], bool]]:
+    """Builds the file and directory predicates, both taking a relative path."""
+
+    extensions = set(formats or [])
+    included = (
+        re.compile("|".join(map(fnmatch.translate, include))) if include else None
+    )
+    excluded = (
+        re.compile("|".join(map(fnmatch.translate, exclude))) if exclude else None
+    )
+
+    def accept_file(relative_path: str) -> bool:
+        if extensions:
+            name = relative_path.rpartition("/")[2]
+            if "." not in name or name.rpartition(".")[2] not in extensions:
+                return False
+        if included is not None and not included.match(relative_path):
+            return False
+        return excluded is None or not excluded.match(relative_path)
+
+    def accept_directory(relative_path: str) -> bool:
+        return excluded is None or not excluded.match(relative_path)
+
+    return accept_file, accept_directory
+
+
+class Scanner:
+    """Streams matching files to `submit` as soon as they are found.
+
+    With more than one job every subdirectory becomes its own task, so large
+    subtrees are scanned in parallel.
+    """
+
+    def __init__(
+        self,
+        submit: Callable[[str, str], None],
+        accept: Tuple[Callable[[str], bool], Callable[[str], bool]],
+        recursive: bool,
+        jobs: int = 1,
+    ):
+        self.submit = submit
+        self.accept_file, self.accept_directory = accept
+        self.recursive = recursive
+        self.jobs = jobs
+
+    def _scan_one(
+        self, local_dir: str, remote_dir: str, prefix: str
+    ) -> List[Tuple[str, str, str]]:
+        """Submits the files of one directory and returns its subdirectories."""
+
+        subdirs = list()
+        try:
+            with os.scandir(local_dir) as entries:
+                for entry in entries:
+                    relative_path = prefix + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.recursive and self.accept_directory(relative_path):
+                            subdirs.append(
+                                (
+                                    entry.path,
+                                    f"{remote_dir}/{entry.name}",
+                                    relative_path + "/",
+                                )
+                            )
+                    elif entry.is_file() and self.accept_file(relative_path):
+                        self.submit(entry.path, f"{remote_dir}/{entry.name}")
+        except OSError as e:
+            # Like os.walk, an unreadable directory is skipped rather than ending
+            # the scan.
+            logger.warning(f"Skipping directory {local_dir}: {e}")
+        return subdirs
+
+    def scan(self, local_dir: str, remote_dir: str):
+        remote_dir = remote_dir.replace("\\", "/").rstrip("/")
+        if self.jobs <= 1:
+            stack = [(local_dir, remote_dir, "")]
+            while stack:
+                stack.extend(reversed(self._scan_one(*stack.pop())))
+            return
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = [executor.submit(self._scan_one, local_dir, remote_dir, "")]
+            while pending:
+                for subdir in pending.pop().result():
+                    pending.append(executor.submit(self._scan_one, *subdir))
+
+
+def scan_paths(args: argparse.Namespace, scanner: Scanner):
+    if args.path == ["."]:
+        logger.info(f"Processing current directory")
+        scanner.scan(".", args.remote_dir)
+    else:
+        for path in args.path:
+            logger.info(f"Processing path: {path}")
+            remote_subdir = os.path.join(
+                args.remote_dir, os.path.basename(path)
+            ).replace("\\", "/")
+            scanner.scan(path, remote_subdir)
+
+
+def collect_files(args: argparse.Namespace, accept) -> List[Tuple[str, str, int]]:
+    files = list()
+    lock = threading.Lock()
+
+    def collect(local_path: str, remote_path: str):
+        try:
+            size = os.path.getsize(local_path)
+        except OSError as e:
+            logger.warning(f"Skipping {local_path}: {e}")
+            return
+        with lock:
+            files.append((local_path, remote_path, size))
+
+    scan_paths(args, Scanner(collect, accept, args.recursive, args.scan_jobs))
+    return files
+
+
+def pack_files(
+    files: List[Tuple[str, str, int]], jobs: int
+) -> List[List[Tuple[str, str, int]]]:
+    """Packs files largest first onto the least loaded connection (LPT).
+
+    A shared queue fed largest first makes the same choices at run time, so this
+    is also the schedule `--order largest` follows on equally fast connections.
+    """
+
+    connections = [list() for _ in range(jobs)]
+    loads = [(0, index) for index in range(jobs)]
+    for file in sorted(files, key=lambda file: file[2], reverse=True):
+        load, index = heapq.heappop(loads)
+        connections[index].append(file)
+        heapq.heappush(loads, (load + file[2], index))
+    return connections
+
+
+def print_plan(args: argparse.Namespace, files: List[Tuple[str, str, int]], jobs: int):
+    server = f"{args.ftp_server}:{args.ftp_port}"
+    if args.bandwidth:
+        measured = {
+            "bytes_per_second": parse_size(args.bandwidth),
+            "seconds_per_file": 0,
+        }
+        source = "given"
+    else:
+        measured = load_bandwidth(server)
+        source = "measured"
+
+    def estimate(connection) -> Optional[float]:
+        if not measured:
+            return None
+        size = sum(file[2] for file in connection)
+        return (
+            size / measured["bytes_per_second"]
+            + len(connection) * measured["seconds_per_file"]
+        )
+
+    total = sum(file[2] for file in files)
+    print(f"Plan: {len(files)} files, {format_size(total)} over {jobs} connections")
+    connections = pack_files(files, jobs)
+    for index, connection in enumerate(connections, 1):
+        size = sum(file[2] for file in connection)
+        seconds = estimate(connection)
+        eta = f", ~{seconds:.0f}s" if seconds is not None else ""
+        print(
+            f"  connection {index}: {len(connection)} files, {format_size(size)}{eta}"
+        )
+        for local_path, remote_path, size in connection[:3]:
+            print(f"      {format_size(size):>10}  {local_path} -> {remote_path}")
+        if len(connection) > 3:
+            print(f"      ... {len(connection) - 3} more")
+
+    if measured:
+        makespan = max(estimate(connection) for connection in connections)
+        print(
+            f"Estimated time: {makespan:.0f}s"
+            f" at {format_size(measured['bytes_per_second'])}/s"
+            f" per connection ({source})"
+        )
+    else:
+        print(
+            "Estimated time: unknown, pass --bandwidth or run one upload to measure it"
+        )
+
 
 def main():
     args = parse_arguments()
-    ftp = connect_to_ftp(args.ftp_server, args.ftp_port, args.ftp_user, args.ftp_pass)
 
-    try:
-        if args.path == ["."]:
-            logger.info(f"Processing current directory")
-            process_directory(ftp, ".", args.remote_dir, args.format, args.recursive, ".")
+    accept = compile_filter(args.format, args.include, args.exclude)
+    jobs = max(1, args.jobs)
+
+    files = None
+    if args.order != "scan" or args.dry_run:
+        files = collect_files(args, accept)
+        files.sort(key=lambda file: file[2], reverse=args.order != "smallest")
+        if args.dry_run:
+            print_plan(args, files, jobs)
+            return
+
+    dedup = None
+    with UploadPool(args, jobs) as pool:
+        submit = pool.submit
+        if args.dedup:
+            dedup = Deduplicator(args, pool.submit)
+            submit = dedup.submit
+
+        if files is None:
+            scan_paths(args, Scanner(submit, accept, args.recursive, args.scan_jobs))
         else:
-            for path in args.path:
-                logger.info(f"Processing path: {path}")
-                remote_subdir = os.path.join(args.remote_dir, os.path.basename(path)).replace("\\", "/")
-                process_directory(ftp, path, remote_subdir, args.format, args.recursive, path)
-    finally:
-        logger.info("Closing FTP connection")
-        ftp.quit()
+            for local_path, remote_path, _ in files:
+                submit(local_path, remote_path)
+
+        if dedup is not None:
+            dedup.wait()
+
+    if dedup is not None:
+        try:
+            dedup.place_duplicates(pool)
+        except ftplib.all_errors as e:
+            logger.error(f"Could not place duplicate files: {e}")
+        dedup.save(pool.failed)
+
+    measured = pool.stats.measured()
+    if measured:
+        save_bandwidth(f"{args.ftp_server}:{args.ftp_port}", measured)
+    if args.report:
+        pool.stats.report()
+    if pool.skipped:
+        logger.info(f"{pool.skipped} unchanged files were skipped")
+    if dedup is not None and dedup.skipped:
+        logger.warning(f"{dedup.skipped} duplicates were not placed on the server")
+    if pool.failed:
+        logger.error(f"{len(pool.failed)} files failed to upload")
+        exit(1)
 
 if __name__ == "__main__":
     logger = setup_logging()
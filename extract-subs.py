@@ -1,33 +1,90 @@
-import re
+import os
 import sys
+import glob
+import json
+import time
+import shutil
 import pysubs2
+import argparse
+import tempfile
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Matroska codec IDs of subtitle formats:
+# (name used with --codec, extension mkvextract writes)
+SUBTITLE_CODECS = {
+    'S_TEXT/UTF8': ('srt', 'srt'),
+    'S_TEXT/ASS': ('ass', 'ass'),
+    'S_TEXT/SSA': ('ssa', 'ssa'),
+    'S_TEXT/WEBVTT': ('webvtt', 'vtt'),
+    'S_HDMV/PGS': ('pgs', 'sup'),
+    'S_VOBSUB': ('vobsub', 'sub'),
+}
+
+
+def run_mkvtoolnix(command):
+    """ Runs an MKVToolNix tool and returns its output; exit status 1 only means
+    it printed warnings, so just 2 and above are errors"""
+    result = subprocess.run(command, stdout=subprocess.PIPE)
+    if not 0 <= result.returncode <= 1:
+        raise subprocess.CalledProcessError(result.returncode, command, result.stdout)
+    return result.stdout
+
+
+def get_subtitle_tracks(file_path):
+    """ Returns the subtitle tracks of the file, as identified by mkvmerge -J"""
+    raw_info = run_mkvtoolnix(["mkvmerge", "-J", file_path])
+    tracks = list()
+    for track in json.loads(raw_info).get('tracks', []):
+        properties = track.get('properties', {})
+        codec = SUBTITLE_CODECS.get(properties.get('codec_id'))
+        if track.get('type') != 'subtitles' or codec is None:
+            continue
+        tracks.append({
+            'id': str(track['id']),
+            'codec': codec[0],
+            'extension': codec[1],
+            'language': properties.get('language') or 'und',
+            'language_ietf': properties.get('language_ietf'),
+        })
+    return tracks
+
+
+def select_tracks(tracks, languages=(), codecs=('srt',)):
+    """ Keeps the tracks in one of `codecs` and, if any are given, one of `languages`"""
+    return [track for track in tracks
+            if track['codec'] in codecs
+            and (not languages
+                 or track['language'] in languages
+                 or track['language_ietf'] in languages)]
 
-def get_mkv_track_id(file_path):
-    """ Returns the track ID of the SRT subtitles track"""
-    try:
-        raw_info = subprocess.check_output(["mkvmerge", "-i", file_path],
-                                           stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as ex:
-        print(ex)
-        sys.exit(1)
-    pattern = re.compile('.* (\d+): subtitles \(SubRip/SRT\).*', re.DOTALL)
-    m = pattern.match(str(raw_info))
-    if m:
-        return raw_info, m.group(1)
-    else:
-        return raw_info, None
+
+def output_paths(file_path, tracks):
+    """ Names the extracted files: <name>.<ext> for a single track, otherwise
+    <name>.<language>.<ext>, adding the track ID where that is ambiguous"""
+    base = os.path.splitext(file_path)[0]
+    if len(tracks) == 1:
+        return [f"{base}.{tracks[0]['extension']}"]
+
+    names = [(track['language'], track['extension']) for track in tracks]
+    return [f"{base}.{track['language']}.{track['id']}.{track['extension']}"
+            if names.count((track['language'], track['extension'])) > 1
+            else f"{base}.{track['language']}.{track['extension']}"
+            for track in tracks]
 
 
 def extract_mkv_subs(file):
-    print("    Extracting embedded subtitles...")
+    """ Extracts all wanted tracks with one mkvextract call, so the file is read once"""
+    print(f"    {file['full_path']}: Extracting embedded subtitles...")
     try:
-        subprocess.call(["mkvextract", "tracks", file['full_path'],
-                         file['srt_track_id'] + ":" + file['srt_full_path']])
-        print("    OK.")
+        targets = [track_id + ":" + path for track_id, path in file['tracks']]
+        run_mkvtoolnix(["mkvextract", "tracks", file['full_path']] + targets)
+        print(f"    {file['full_path']}: OK.")
     except subprocess.CalledProcessError:
-        print("    ERROR: Could not extract subtitles")
+        print(f"    {file['full_path']}: ERROR: Could not extract subtitles")
+        raise
 
 
 def remove_duplicates(seq):
@@ -36,23 +93,173 @@ def remove_duplicates(seq):
     return [x for x in seq if not (x in seen or seen_add(x))]
 
 
-def main():
-    if len(sys.argv) > 1:
-        file_path = sys.argv[1]
-        srt_path = file_path.replace(file_path[file_path.rfind('.') + 1:], 'srt')
-        _, track_id = get_mkv_track_id(file_path)
-        if track_id is None:
-            print('This file has not embedded subtitles.')
-            return
+def clean_srt(srt_path):
+    subs = pysubs2.load(srt_path)
+
+    with open(srt_path, 'w') as file:
+        lines = [line.text.replace(r'\N', ' ') for line in subs]
+        file.write("\n".join(remove_duplicates(lines)))
+
+
+def up_to_date(file_path, paths):
+    """ Whether all the subtitle files were written after the .mkv was last modified"""
+    try:
+        mtime = os.path.getmtime(file_path)
+        return all(os.path.getmtime(path) >= mtime for path in paths)
+    except OSError:
+        return False
+
+
+def partial_path(path):
+    """ Where a track is written until it is complete; mkvextract needs the extension"""
+    root, extension = os.path.splitext(path)
+    return f"{root}.partial{extension}"
+
+
+def companions(path):
+    """ The files mkvextract writes for one track: VobSub comes as an .idx/.sub pair"""
+    root, extension = os.path.splitext(path)
+    return [path, root + '.idx'] if extension == '.sub' else [path]
+
+
+def process_file(file_path, force=False, languages=(), codecs=('srt',)):
+    """ Probes, extracts and cleans the subtitles of one file; returns what happened"""
+    partials = list()
+    try:
+        tracks = select_tracks(get_subtitle_tracks(file_path), languages, codecs)
+        if not tracks:
+            return 'no embedded subtitles'
+        paths = output_paths(file_path, tracks)
+        if not force and up_to_date(file_path, paths):
+            return 'up to date'
+
+        # Extract and clean under temporary names, so an interrupted or failed run
+        # never leaves a truncated file that looks up to date.
+        partials = [partial_path(path) for path in paths]
         extract_mkv_subs({
             'full_path': file_path,
-            'srt_track_id': track_id,
-            'srt_full_path': srt_path
+            'tracks': [(track['id'], path) for track, path in zip(tracks, partials)],
         })
-        subs = pysubs2.load(srt_path)
+        for track, path in zip(tracks, partials):
+            if track['codec'] == 'srt':
+                clean_srt(path)
+        for partial, path in zip(partials, paths):
+            for source, target in zip(companions(partial), companions(path)):
+                if os.path.exists(source):
+                    os.replace(source, target)
+    except (subprocess.CalledProcessError, ValueError, OSError,
+            pysubs2.Pysubs2Error) as ex:
+        # UnicodeDecodeError is a ValueError; a missing mkvmerge is an OSError.
+        print(f"{file_path}: {ex}", file=sys.stderr)
+        for partial in partials:
+            for path in companions(partial):
+                if os.path.exists(path):
+                    os.remove(path)
+        return 'failed'
+
+    return 'extracted' if len(tracks) == 1 else f'extracted {len(tracks)} tracks'
+
+
+def find_files(patterns):
+    """ Expands files, directories (searched recursively for .mkv) and globs"""
+    files = list()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(glob.escape(pattern), '**', '*.mkv'),
+                                recursive=True)
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = glob.glob(pattern, recursive=True)
+        files.extend(sorted(matches))
+    return remove_duplicates(files)
+
+
+def run_batch(files, jobs, force=False, languages=(), codecs=('srt',)):
+    """ Processes files concurrently; the work is done by mkvmerge/mkvextract, so
+    threads suffice"""
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(
+            lambda path: process_file(path, force, languages, codecs), files))
+    for path, result in zip(files, results):
+        print(f"{path}: {result}")
+    return results
+
 
-        with open(srt_path, 'w') as file:
-            file.write("\n".join(remove_duplicates([line.text.replace(r'\N', ' ') for line in subs])))
+def benchmark(count, jobs):
+    """ Times serial against parallel extraction on generated MKVs"""
+    directory = tempfile.mkdtemp(prefix='extract-subs-')
+    try:
+        files = list()
+        for i in range(count):
+            srt = os.path.join(directory, f'source{i}.srt')
+            with open(srt, 'w') as file:
+                for n in range(2000):
+                    start, end = divmod(n * 3, 60), divmod(n * 3 + 2, 60)
+                    file.write(f"{n + 1}\n00:{start[0]:02d}:{start[1]:02d},000 --> "
+                               f"00:{end[0]:02d}:{end[1]:02d},000\nLine {n % 500}\n\n")
+            mkv = os.path.join(directory, f'episode{i}.mkv')
+            subprocess.check_call(["mkvmerge", "-q", "-o", mkv, srt],
+                                  stdout=subprocess.DEVNULL)
+            os.remove(srt)
+            files.append(mkv)
+
+        timings = dict()
+        for label, workers in (('serial', 1), ('parallel', jobs)):
+            started = time.perf_counter()
+            run_batch(files, workers, force=True)
+            timings[label] = time.perf_counter() - started
+
+        print(f"{count} files: serial {timings['serial']:.2f}s, "
+              f"{jobs} jobs {timings['parallel']:.2f}s, "
+              f"speedup {timings['serial'] / timings['parallel']:.2f}x")
+    finally:
+        shutil.rmtree(directory)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Extract the subtitles embedded in MKV files")
+    parser.add_argument('paths', nargs='*', help="MKV files, directories or globs")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Files processed concurrently (lower for spinning disks)")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Extract even when the subtitles are up to date")
+    parser.add_argument('-l', '--lang', action='append', default=list(),
+                        help="Only extract tracks in this language, e.g. eng or en "
+                             "(repeatable; default: all)")
+    parser.add_argument('-c', '--codec', action='append',
+                        choices=sorted(c for c, _ in SUBTITLE_CODECS.values()),
+                        help="Subtitle formats to extract (repeatable; default: srt)")
+    parser.add_argument('--benchmark', type=int, metavar='N',
+                        help="Time serial against parallel extraction on N generated "
+                             "MKVs and exit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    codecs = tuple(args.codec or ['srt'])
+    if args.benchmark:
+        benchmark(args.benchmark, max(1, args.jobs))
+        return
+
+    if len(args.paths) == 1 and os.path.isfile(args.paths[0]):
+        result = process_file(args.paths[0], args.force, args.lang, codecs)
+        if result == 'no embedded subtitles':
+            print('This file has not embedded subtitles.')
+        elif result == 'up to date':
+            print('Subtitles are up to date.')
+        elif result == 'failed':
+            sys.exit(1)
+    elif args.paths:
+        files = find_files(args.paths)
+        if not files:
+            print('No MKV files found.', file=sys.stderr)
+            sys.exit(1)
+        results = run_batch(files, max(1, args.jobs), args.force, args.lang, codecs)
+        if 'failed' in results:
+            sys.exit(1)
     else:
         print('No arguments provided.', file=sys.stderr)
 
@@ -1,26 +1,349 @@
+import re
 import sys
+import argparse
 import requests
+import posixpath
 
-from lxml import html
-from urllib.parse import urlsplit
-
-if len(sys.argv) < 2:
-    print("not enough arguments..")
-    exit(1)
-
-url = sys.argv[1]
-s = urlsplit(url)
-r = requests.get(url)
-tree = html.document_fromstring(r.text)
-viable_elements = tree.xpath('//body//a[@href]')
-links = list()
-for el in viable_elements:
-    try:
-        links.append(s.scheme + '://' + s.hostname + s.path + str(el.attrib['href']))
-    except Exception as exc:
-        pass
-
-with open("/tmp/links.txt", 'w') as file:
-    file.write('\n'.join(links))
-
-exit(0)
+from lxml import etree, html
+from datetime import datetime
+from urllib.parse import unquote, urljoin, urlsplit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+# What fetching and parsing one page can raise; lxml refuses empty documents
+# with a ParserError.
+FETCH_ERRORS = (requests.RequestException, ValueError, etree.LxmlError)
+
+
+def fetch_links(session, url, timeout):
+    r = session.get(url, timeout=timeout)
+    r.raise_for_status()
+    tree = html.document_fromstring(r.content)
+    viable_elements = tree.xpath('//body//a[@href]')
+    # Resolve against the final URL, so redirects and <base> are honoured.
+    base = tree.xpath('string(//head/base/@href)') or r.url
+    return [urljoin(base, str(el.attrib['href']).strip()) for el in viable_elements]
+
+
+def read_urls(path):
+    file = sys.stdin if path == '-' else open(path)
+    with file:
+        urls = (line.strip() for line in file)
+        return list(
+            dict.fromkeys(url for url in urls if url and not url.startswith('#'))
+        )
+
+
+def make_session(jobs):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_batch(urls, output, jobs, timeout):
+    """Fetch `urls` concurrently and write each new link to `output` as soon as
+    its page is done. Returns the number of pages that failed."""
+
+    session = make_session(jobs)
+
+    seen = set()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(fetch_links, session, url, timeout): url for url in urls
+        }
+        for future in as_completed(futures):
+            try:
+                links = future.result()
+            except FETCH_ERRORS as exc:
+                print(f"{futures[future]}: {exc}", file=sys.stderr)
+                failed += 1
+                continue
+
+            new_links = [link for link in dict.fromkeys(links) if link not in seen]
+            seen.update(new_links)
+            if new_links:
+                output.write('\n'.join(new_links) + '\n')
+                output.flush()
+    return failed
+
+
+# Apache writes "2024-01-31 12:00" and nginx "31-Jan-2024 12:00"; both put the
+# size after it.
+LISTING_RE = re.compile(
+    r'(?P<mtime>\d{4}-\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?'
+    r'|\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}(?::\d{2})?)'
+    r'\s+(?P<size>\d+(?:\.\d+)?[KMGTP]?|-)'
+)
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40, 'P': 2**50}
+
+
+def parse_size(text):
+    """Parse "1234", "1.5M" or "700K" into bytes; None for "-" or nothing."""
+
+    match = re.fullmatch(
+        r'(\d+(?:\.\d+)?)\s*([KMGTP]?)i?B?', text.strip(), re.IGNORECASE
+    )
+    if match is None:
+        return None
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def parse_mtime(text):
+    for fmt in (
+        '%Y-%m-%d %H:%M',
+        '%Y-%m-%d %H:%M:%S',
+        '%d-%b-%Y %H:%M',
+        '%d-%b-%Y %H:%M:%S',
+    ):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def entry_details(el):
+    """Text describing a listing entry: the rest of its <tr> row, or the text
+    up to the next link in <pre> listings."""
+
+    row = next(el.iterancestors('tr'), None)
+    if row is not None:
+        return ' '.join(
+            cell.text_content() for cell in row if el not in cell.iterdescendants()
+        )
+    return el.tail or ''
+
+
+def read_listing(session, url, timeout):
+    """Return the (url, size, mtime) of the files and the urls of the
+    subdirectories listed on an autoindex page."""
+
+    r = session.get(url, timeout=timeout)
+    r.raise_for_status()
+    # A redirect to the slash-terminated form is common; listed paths are
+    # relative to it.
+    url = r.url
+    tree = html.document_fromstring(r.content)
+
+    files, directories = list(), list()
+    for el in tree.xpath('//body//a[@href]'):
+        href = str(el.attrib['href']).strip()
+        link = urljoin(url, href).split('#', 1)[0]
+        # Skip the parent directory, column sorting links and anything off-tree.
+        if '?' in href or not link.startswith(url) or link == url:
+            continue
+        if link.endswith('/'):
+            directories.append(link)
+            continue
+
+        size = mtime = None
+        match = LISTING_RE.search(entry_details(el))
+        if match is not None:
+            size = parse_size(match.group('size'))
+            mtime = parse_mtime(match.group('mtime'))
+        files.append((link, size, mtime))
+    return files, directories
+
+
+def wanted(link, size, extensions, min_size, max_size):
+    if extensions and not link.lower().endswith(extensions):
+        return False
+    # Entries without a size column are kept; only known sizes are filtered.
+    if size is not None and min_size is not None and size < min_size:
+        return False
+    if size is not None and max_size is not None and size > max_size:
+        return False
+    return True
+
+
+def aria2_entry(link, size, mtime, root, out_dir):
+    """An aria2c input-file entry saving `link` under `out_dir`, mirroring its
+    path below `root`, preceded by a comment with the listed size and mtime.
+    Returns None when the decoded path would leave `out_dir`."""
+
+    relative = posixpath.normpath(
+        unquote(urlsplit(link).path[len(urlsplit(root).path) :])
+    )
+    # Encoded slashes ("..%2F") only turn into parent references once decoded.
+    if relative.startswith(('/', '../')) or relative in ('.', '..'):
+        print(f"{link}: path leaves the download directory, skipping", file=sys.stderr)
+        return None
+    directory, name = posixpath.split(relative)
+    details = ' '.join(
+        f"{key}={value}"
+        for key, value in (
+            ('size', size),
+            ('mtime', mtime and mtime.isoformat(' ', 'minutes')),
+        )
+        if value is not None
+    )
+    comment = f"# {details}\n" if details else ''
+    directory = posixpath.join(out_dir, directory).rstrip('/')
+    return f"{comment}{link}\n  dir={directory}\n  out={name}\n"
+
+
+def walk_indexes(
+    roots,
+    output,
+    jobs,
+    timeout,
+    extensions=(),
+    min_size=None,
+    max_size=None,
+    out_dir='.',
+):
+    """Walk autoindex listings below `roots` with at most `jobs` pages in flight,
+    writing an aria2c input file of the wanted files as listings come in.
+    Returns the number of listings that failed."""
+
+    session = make_session(jobs)
+    seen = set()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = dict()
+        for root in roots:
+            root = root if root.endswith('/') else root + '/'
+            seen.add(root)
+            future = executor.submit(read_listing, session, root, timeout)
+            pending[future] = (root, root)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, root = pending.pop(future)
+                try:
+                    files, directories = future.result()
+                except FETCH_ERRORS as exc:
+                    print(f"{url}: {exc}", file=sys.stderr)
+                    failed += 1
+                    continue
+
+                for directory in directories:
+                    if directory not in seen:
+                        seen.add(directory)
+                        child = executor.submit(
+                            read_listing, session, directory, timeout
+                        )
+                        pending[child] = (directory, root)
+
+                entries = [
+                    aria2_entry(link, size, mtime, root, out_dir)
+                    for link, size, mtime in files
+                    if link not in seen
+                    and wanted(link, size, extensions, min_size, max_size)
+                ]
+                seen.update(link for link, _, _ in files)
+                entries = [entry for entry in entries if entry is not None]
+                if entries:
+                    output.write(''.join(entries))
+                    output.flush()
+    return failed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Extract the links of web pages")
+    parser.add_argument(
+        'url', nargs='?', help="Page whose links are written to /tmp/links.txt"
+    )
+    parser.add_argument(
+        '-i',
+        '--input',
+        help="File with one URL per line ('-' for stdin) to fetch in batch",
+    )
+    parser.add_argument(
+        '-o', '--output', help="Where batch results go (default: stdout)"
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=8,
+        help="Pages fetched concurrently in batch mode",
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=30, help="Seconds to wait for each server"
+    )
+    parser.add_argument(
+        '-w',
+        '--walk',
+        action='store_true',
+        help="Walk the given autoindex pages recursively into an aria2c input file",
+    )
+    parser.add_argument(
+        '-x',
+        '--ext',
+        action='append',
+        default=list(),
+        help="With --walk, only keep files with this extension (repeatable)",
+    )
+    parser.add_argument(
+        '--min-size',
+        type=parse_size,
+        help="With --walk, skip files smaller than this (e.g. 100M)",
+    )
+    parser.add_argument(
+        '--max-size', type=parse_size, help="With --walk, skip files larger than this"
+    )
+    parser.add_argument(
+        '-d',
+        '--dir',
+        default='.',
+        help="With --walk, the local directory mirroring the root",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    if args.walk:
+        roots = read_urls(args.input) if args.input else list()
+        if args.url is not None:
+            roots.insert(0, args.url)
+        if not roots:
+            print("not enough arguments..")
+            exit(1)
+
+        extensions = tuple('.' + ext.lower().lstrip('.') for ext in args.ext)
+        output = open(args.output, 'w') if args.output else sys.stdout
+        with output:
+            failed = walk_indexes(
+                roots,
+                output,
+                max(1, args.jobs),
+                args.timeout,
+                extensions,
+                args.min_size,
+                args.max_size,
+                args.dir,
+            )
+        exit(1 if failed else 0)
+
+    if args.input is None:
+        if args.url is None:
+            print("not enough arguments..")
+            exit(1)
+        try:
+            links = fetch_links(requests.Session(), args.url, args.timeout)
+        except FETCH_ERRORS as exc:
+            print(f"{args.url}: {exc}", file=sys.stderr)
+            exit(1)
+        with open("/tmp/links.txt", 'w') as file:
+            file.write('\n'.join(links))
+        exit(0)
+
+    urls = read_urls(args.input)
+    if args.url is not None:
+        urls.insert(0, args.url)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    with output:
+        failed = fetch_batch(urls, output, max(1, args.jobs), args.timeout)
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()